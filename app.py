@@ -1,13 +1,420 @@
+import asyncio
+import codecs
+import hashlib
+import json
+import os
+import re
+import secrets
+import threading
+import time
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from xml.sax.saxutils import escape
+import httpx
 import streamlit as st
-from openai import OpenAI
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 from io import BytesIO
-from reportlab.lib.pagesizes import letter
-from reportlab.lib.styles import getSampleStyleSheet
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, ListFlowable, ListItem
-from docx import Document
+
+MODEL = "gpt-4o"
+RESPONSE_CACHE_SIZE = 32
+DEBUG = os.environ.get("ETL_VALIDATOR_DEBUG", "") == "1"
+
+# --- Input size limits ---
+COMPRESS_THRESHOLD = 40 * 1024   # characters; slim the ETL file before prompting above this size
+MAX_PROMPT_TOKENS = 100_000      # ETL + PySpark up to this go in a single call; larger ETL files are map-reduced
+MAX_INPUT_TOKENS = 1_000_000     # refuse outright above this
+ETL_CHUNK_TOKENS = 40_000
+MAP_CONCURRENCY = 4
+
+# --- Output (max_tokens) budgets ---
+VALIDATION_MAX_TOKENS = 4_096
+MAP_MAX_TOKENS = 1_024
+MAX_OUTPUT_TOKENS = 16_384
+# The corrected file has to come back in full next to the report. It is returned JSON-escaped (quotes,
+# newlines, backslashes), which costs up to about a quarter more tokens than the original file.
+# Larger PySpark files are still validated, but only the report is requested
+MAX_PYSPARK_TOKENS = (MAX_OUTPUT_TOKENS - VALIDATION_MAX_TOKENS - 512) * 4 // 5
+
+UPLOAD_READ_SIZE = 1 << 20
 
 # --- OpenAI API Key (from Streamlit Secrets) ---
-client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
+# One client per process: its HTTP/2 connection pool (and TLS sessions) is reused by every rerun and session
+@st.cache_resource(show_spinner=False)
+def get_client():
+    return AsyncOpenAI(
+        api_key=st.secrets["OPENAI_API_KEY"],
+        http_client=DefaultAsyncHttpxClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+        ),
+    )
+
+# --- Background event loop, kept alive across reruns so the cached client's connections stay usable ---
+@st.cache_resource(show_spinner=False)
+def get_event_loop():
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+# --- Finished (report, corrected code) pairs keyed by (etl_sha256, pyspark_sha256, etl_kind, model) ---
+# Streamed responses can't go through st.cache_data, so results are stored here once complete.
+# The store is shared by every session in the process, hence the lock
+@st.cache_resource(show_spinner=False)
+def get_response_cache():
+    return OrderedDict(), threading.Lock()
+
+# --- ReportLab setup, done once per process on first report export (a module global would be rebuilt on every rerun) ---
+@st.cache_resource(show_spinner=False)
+def get_styles():
+    from reportlab import rl_config
+    from reportlab.lib.styles import getSampleStyleSheet
+
+    # Skip shape validation outside debug
+    if not DEBUG:
+        rl_config.shapeChecking = 0
+    return getSampleStyleSheet()
+
+def run_async(coro):
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result()
+
+def iter_async(aiterator):
+    loop = get_event_loop()
+    while True:
+        try:
+            yield asyncio.run_coroutine_threadsafe(aiterator.__anext__(), loop).result()
+        except StopAsyncIteration:
+            return
+
+def chunk_text(chunk):
+    if chunk.choices and chunk.choices[0].delta.content:
+        return chunk.choices[0].delta.content
+    return ""
+
+# ----------- Helper Functions for Streamed JSON -----------
+_JSON_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+def stream_json_fields(deltas):
+    # Incrementally decode a streamed flat JSON object of string fields. Yields (field, text) fragments
+    # as they arrive and (field, None) once a field's value is complete
+    key, reading, text, pending = None, None, [], ""
+    for delta in deltas:
+        pending += delta
+        i, n = 0, len(pending)
+        while i < n:
+            ch = pending[i]
+            if reading is None:
+                if ch == '"':
+                    reading = "key" if key is None else "value"
+                    text = []
+                elif ch == ",":
+                    key = None
+                i += 1
+            elif ch == "\\":
+                # Wait for the rest of an escape sequence that was split across deltas
+                if i + 1 >= n or (pending[i + 1] == "u" and i + 6 > n):
+                    break
+                if pending[i + 1] == "u":
+                    code = int(pending[i + 2:i + 6], 16)
+                    if 0xD800 <= code < 0xDC00:
+                        # High surrogate: combine with the \uXXXX low half that follows it
+                        if i + 12 > n:
+                            break
+                        if pending[i + 6:i + 8] == "\\u":
+                            code = 0x10000 + ((code - 0xD800) << 10) + (int(pending[i + 8:i + 12], 16) - 0xDC00)
+                            i += 6
+                    text.append(chr(code))
+                    i += 6
+                else:
+                    text.append(_JSON_ESCAPES.get(pending[i + 1], pending[i + 1]))
+                    i += 2
+            elif ch == '"':
+                if reading == "key":
+                    key = "".join(text)
+                else:
+                    yield key, "".join(text)
+                    yield key, None
+                    key = None
+                reading = None
+                i += 1
+            else:
+                text.append(ch)
+                i += 1
+        pending = pending[i:]
+        if reading == "value" and text:
+            yield key, "".join(text)
+            text = []
+
+def json_field_text(fields, name):
+    # Consume (field, text) pairs from stream_json_fields up to the end of the `name` field
+    for field, text in fields:
+        if field == name:
+            if text is None:
+                return
+            yield text
+
+# ----------- Helper Functions for Validation Requests -----------
+INCOMPLETE_CORRECTION_WARNING = (
+    "⚠️ The corrected PySpark code doesn't fit in the output token limit, so it is not shown or offered "
+    "for download. The validation report above is complete."
+)
+
+def lookup_response(cache_key):
+    response_cache, lock = get_response_cache()
+    with lock:
+        hit = response_cache.get(cache_key)
+        if hit is not None:
+            response_cache.move_to_end(cache_key)
+    return hit
+
+def remember_response(cache_key, report, corrected):
+    response_cache, lock = get_response_cache()
+    with lock:
+        response_cache[cache_key] = (report, corrected)
+        response_cache.move_to_end(cache_key)
+        if len(response_cache) > RESPONSE_CACHE_SIZE:
+            response_cache.popitem(last=False)
+
+def parse_validation_response(content, finish_reason=None):
+    if finish_reason == "length":
+        # Cut off by max_tokens: keep the report only if its closing quote arrived, and drop the incomplete code
+        report = []
+        for field, text in stream_json_fields([content]):
+            if field == "report":
+                if text is None:
+                    return "".join(report).strip(), None
+                report.append(text)
+        raise ValueError("The response hit the output token limit before the validation report was complete.")
+    result = json.loads(content)
+    return result["report"].strip(), result["corrected"].strip()
+
+def stream_validation(client, request):
+    stream = run_async(client.chat.completions.create(**request, stream=True))
+    raw = []
+    finish_reason = None
+
+    def _deltas():
+        nonlocal finish_reason
+        for chunk in iter_async(stream):
+            if chunk.choices and chunk.choices[0].finish_reason:
+                finish_reason = chunk.choices[0].finish_reason
+            raw.append(chunk_text(chunk))
+            yield raw[-1]
+
+    # Streamlit interrupts the script with a rerun/stop exception when a widget changes mid-stream;
+    # always close the stream so generation (and billing) stops instead of running on in the background
+    try:
+        # Render both fields live as the JSON streams in; the final values come from the parsed response below
+        fields = stream_json_fields(_deltas())
+        st.markdown("### 📝 Validation Report")
+        st.write_stream(json_field_text(fields, "report"))
+
+        st.markdown("### 🛠️ Corrected PySpark Code")
+        code_placeholder = st.empty()
+        corrected = ""
+        last_render = 0.0
+        for text in json_field_text(fields, "corrected"):
+            corrected += text
+            if time.monotonic() - last_render > 0.1:
+                code_placeholder.code(corrected, language="python")
+                last_render = time.monotonic()
+        for _ in fields:
+            pass
+    finally:
+        run_async(stream.close())
+
+    report, corrected = parse_validation_response("".join(raw), finish_reason)
+    # None: the code was cut off; "": a report-only request for a PySpark file too large to rewrite
+    if not corrected:
+        code_placeholder.empty()
+        st.warning(INCOMPLETE_CORRECTION_WARNING)
+    else:
+        code_placeholder.code(corrected, language="python")
+    return report, corrected
+
+# --- OpenAI Batch API: half price, results within 24h ---
+# Jobs are tagged with metadata so they can be found again after a reload or expired session. Everyone shares
+# one API key, so recovery is limited to the submitting browser's owner token or to the files it uploaded
+BATCH_APP_TAG = "etl-pyspark-validator"
+BATCH_LIST_LIMIT = 100
+_BATCH_KEY_FIELDS = ("etl_sha256", "pyspark_sha256", "etl_kind", "model")
+
+def batch_owner():
+    # Random per-browser token kept in the URL, so it survives reloads and bookmarks but isn't shared between visitors
+    owner = st.query_params.get("owner")
+    if not owner:
+        owner = st.query_params["owner"] = secrets.token_urlsafe(16)
+    return owner
+
+async def submit_batch(client, request, name, cache_key, owner):
+    custom_id = f"{cache_key[0][:16]}-{cache_key[1][:16]}"
+    line = json.dumps({"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": request})
+    batch_file = await client.files.create(file=("validation.jsonl", line.encode("utf-8")), purpose="batch")
+    return await client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+        metadata={
+            "app": BATCH_APP_TAG, "owner": owner, "name": name[:512], **dict(zip(_BATCH_KEY_FIELDS, cache_key)),
+        },
+    )
+
+def batch_job(batch):
+    metadata = batch.metadata or {}
+    has_key = all(field in metadata for field in _BATCH_KEY_FIELDS)
+    return {
+        "id": batch.id,
+        "name": metadata.get("name", batch.id),
+        "cache_key": tuple(metadata[field] for field in _BATCH_KEY_FIELDS) if has_key else None,
+        "status": batch.status,
+    }
+
+def owns_batch(batch, owner, upload_key=None):
+    metadata = batch.metadata or {}
+    if metadata.get("app") != BATCH_APP_TAG:
+        return False
+    return metadata.get("owner") == owner or (
+        upload_key is not None and tuple(metadata.get(field) for field in _BATCH_KEY_FIELDS) == upload_key
+    )
+
+async def load_batch_jobs(client, owner, batch_id="", upload_key=None):
+    # Recent jobs from this browser, plus a job looked up by ID if it was submitted for the uploaded files
+    page = await client.batches.list(limit=BATCH_LIST_LIMIT)
+    jobs = [batch_job(batch) for batch in page.data if owns_batch(batch, owner)]
+    if batch_id and all(job["id"] != batch_id for job in jobs):
+        batch = await client.batches.retrieve(batch_id)
+        if not owns_batch(batch, owner, upload_key):
+            raise ValueError(
+                f"batch job {batch_id} wasn't submitted from this browser. "
+                "Upload the same ETL and PySpark files to look it up."
+            )
+        jobs.append(batch_job(batch))
+    return jobs
+
+def add_batch_jobs(jobs, found):
+    known = {job["id"] for job in jobs}
+    jobs.extend(job for job in found if job["id"] not in known)
+
+async def refresh_batch_jobs(client, jobs):
+    async def _refresh(job):
+        # Each job is updated on its own so one bad batch doesn't leave the others half-refreshed
+        job.pop("refresh_error", None)
+        try:
+            batch = await client.batches.retrieve(job["id"])
+            if batch.status in ("failed", "expired", "cancelled"):
+                job["error"] = f"Batch job {batch.status}."
+            elif batch.status == "completed":
+                result_file_id = batch.output_file_id or batch.error_file_id
+                if result_file_id is None:
+                    job["error"] = "Batch job completed without an output or error file."
+                else:
+                    content = await client.files.content(result_file_id)
+                    result = json.loads(content.text.splitlines()[0])
+                    response = result.get("response") or {}
+                    if result.get("error") or response.get("status_code") != 200:
+                        job["error"] = f"Batch request failed: {result.get('error') or response.get('body')}"
+                    else:
+                        choice = response["body"]["choices"][0]
+                        try:
+                            job["report"], job["corrected"] = parse_validation_response(
+                                choice["message"]["content"], choice.get("finish_reason")
+                            )
+                        except ValueError as e:
+                            # The result file is final, so a malformed or cut-off response won't improve on refresh
+                            job["error"] = f"Batch response could not be read: {e}"
+                        else:
+                            # A cut-off result is left uncached so validating the same files again retries it
+                            if job["cache_key"] is not None and job["corrected"] is not None:
+                                remember_response(job["cache_key"], job["report"], job["corrected"])
+            job["status"] = batch.status
+        except Exception as e:
+            job["refresh_error"] = f"Could not check this job: {e}"
+
+    await asyncio.gather(*(_refresh(job) for job in jobs if "report" not in job and "error" not in job))
+
+# --- Tokenizer for prompt budgeting, loaded once per process ---
+@st.cache_resource(show_spinner=False)
+def get_encoding():
+    import tiktoken
+
+    return tiktoken.encoding_for_model(MODEL)
+
+# Keyed on a SHA-256 that identifies exactly the text being counted; the leading underscore keeps
+# Streamlit from hashing the text itself
+@st.cache_data(show_spinner=False, max_entries=64)
+def count_tokens(text_sha256, _text):
+    return len(get_encoding().encode(_text, disallowed_special=()))
+
+# ----------- Helper Functions for Uploads -----------
+def read_upload(file):
+    # Hash and decode in 1 MB slices: no second full-size bytes copy, and the SHA-256 comes for free.
+    # The incremental decoder keeps multi-byte characters that straddle a slice boundary intact
+    file.seek(0)
+    hasher = hashlib.sha256()
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+    parts = []
+    while chunk := file.read(UPLOAD_READ_SIZE):
+        hasher.update(chunk)
+        parts.append(decoder.decode(chunk))
+    parts.append(decoder.decode(b"", final=True))
+    return "".join(parts), hasher.hexdigest()
+
+# ----------- Helper Functions for Large ETL Inputs -----------
+_XML_COMMENT_RE = re.compile(r"<!--.*?-->", re.DOTALL)
+_XML_GAP_RE = re.compile(r">\s+<")
+
+def compress_etl(text, file_name):
+    if len(text) <= COMPRESS_THRESHOLD:
+        return text
+    if file_name.lower().endswith(".xml"):
+        # Comments and indentation between tags carry no mapping logic
+        return _XML_GAP_RE.sub("><", _XML_COMMENT_RE.sub("", text))
+    # DSX / JSON / TXT: indentation and blank lines are cosmetic
+    return "\n".join(line.strip() for line in text.splitlines() if line.strip())
+
+def split_etl(text, size):
+    chunks = []
+    while len(text) > size:
+        # Prefer cutting at a line break, then between two XML tags
+        cut = text.rfind("\n", 0, size)
+        if cut <= 0:
+            cut = text.rfind("><", 0, size) + 1
+        if cut <= 0:
+            cut = size
+        chunks.append(text[:cut])
+        text = text[cut:]
+    chunks.append(text)
+    return chunks
+
+async def validate_etl_chunks(client, chunks, etl_kind, pyspark_content):
+    semaphore = asyncio.Semaphore(MAP_CONCURRENCY)
+
+    async def _validate(part, chunk):
+        prompt = f"""
+        You are an ETL to PySpark conversion validator.
+
+        The ETL file is too large to review at once, so you are given one part of it.
+        Check only the logic present in this part against the PySpark code and list concise findings under:
+        - ✅ Correct parts
+        - ⚠️ Potential issues
+        - ❌ Missing logic
+
+        Output PySpark file:
+        {pyspark_content}
+
+        Input ETL file (from {etl_kind}), part {part} of {len(chunks)}:
+        {chunk}
+        """
+        async with semaphore:
+            response = await client.chat.completions.create(
+                model=MODEL,
+                messages=[{"role": "user", "content": prompt}],
+                temperature=0,
+                max_tokens=MAP_MAX_TOKENS
+            )
+        return f"Part {part}:\n{response.choices[0].message.content.strip()}"
+
+    return await asyncio.gather(*(_validate(part, chunk) for part, chunk in enumerate(chunks, 1)))
 
 # --- Streamlit Page Config ---
 st.set_page_config(page_title="ETL to PySpark Validator", page_icon="⚡", layout="wide")
@@ -62,69 +469,125 @@ validation_report = None
 corrected_pyspark = None
 
 # ----------- Validation Section -----------
+queue_batch = st.checkbox(
+    "🕒 Queue for batch (50% cheaper, results within 24h)",
+    help="Submit through the OpenAI Batch API instead of validating live. Suited to large overnight runs.",
+)
+
 if st.button("🚀 Validate Conversion"):
     if (informatica_file or datastage_file) and pyspark_file:
         st.info("⏳ Validating conversion... please wait.")
 
         # Read contents
-        input_content = ""
-        if informatica_file:
-            input_content = informatica_file.read().decode("utf-8", errors="ignore")
-        elif datastage_file:
-            input_content = datastage_file.read().decode("utf-8", errors="ignore")
-
-        pyspark_content = pyspark_file.read().decode("utf-8", errors="ignore")
-
-        # Call OpenAI API for validation
-        validation_prompt = f"""
-        You are an ETL to PySpark conversion validator.
-        
-        Input ETL file (from {'Informatica' if informatica_file else 'Datastage'}):
-        {input_content}
+        etl_file = informatica_file or datastage_file
+        input_content, etl_sha256 = read_upload(etl_file)
+        pyspark_content, pyspark_sha256 = read_upload(pyspark_file)
+        etl_kind = "Informatica" if informatica_file else "Datastage"
 
-        Output PySpark file:
-        {pyspark_content}
-
-        Validate whether the PySpark code correctly implements the ETL logic.
-        Provide a detailed validation report with clear sections:
-        - ✅ Correct parts
-        - ⚠️ Potential issues
-        - ❌ Missing logic
-        - 💡 Suggested improvements
-        """
+        cache_key = (etl_sha256, pyspark_sha256, etl_kind, MODEL)
+        cached_response = lookup_response(cache_key)
 
         try:
-            response = client.chat.completions.create(
-                model="gpt-4o",
-                messages=[{"role": "user", "content": validation_prompt}],
-                temperature=0
-            )
-
-            validation_report = response.choices[0].message.content.strip()
-            st.success("✅ Validation Completed")
-            st.markdown("### 📝 Validation Report")
-            st.write(validation_report)
-
-            # --- Step 2: Ask LLM to correct the PySpark file ---
-            correction_prompt = f"""
-            Based on the ETL input and PySpark output above, rewrite the PySpark code so that it
-            fully and correctly implements the ETL logic.
-            
-            IMPORTANT:
-            - Return only the corrected PySpark code.
-            - If the original file is already correct, return the same code unchanged.
-            """
-
-            correction_response = client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": "You are an expert PySpark converter."},
-                    {"role": "user", "content": f"ETL Input:\n{input_content}\n\nPySpark Output:\n{pyspark_content}\n\n{correction_prompt}"}
-                ],
-                temperature=0
-            )
-
-            corrected_pyspark = correction_response.choices[0].message.content.strip()
+            if cached_response is not None:
+                validation_report, corrected_pyspark = cached_response
+                st.markdown("### 📝 Validation Report")
+                st.write(validation_report)
+                st.success("✅ Validation Completed (cached result)")
+                st.markdown("### 🛠️ Corrected PySpark Code")
+                if corrected_pyspark:
+                    st.code(corrected_pyspark, language="python")
+                else:
+                    st.warning(INCOMPLETE_CORRECTION_WARNING)
+            else:
+                client = get_client()
+                input_content = compress_etl(input_content, etl_file.name)
+                # compress_etl's output depends on the file name, so hash the compressed text rather than reuse the upload's hash
+                etl_tokens = count_tokens(hashlib.sha256(input_content.encode("utf-8")).hexdigest(), input_content)
+                pyspark_tokens = count_tokens(pyspark_sha256, pyspark_content)
+
+                if etl_tokens + pyspark_tokens > MAX_INPUT_TOKENS:
+                    st.error(
+                        f"❌ Files are too large to validate ({etl_tokens:,} ETL + {pyspark_tokens:,} PySpark tokens). "
+                        "Please split the job into smaller ETL/PySpark pairs."
+                    )
+                    st.stop()
+
+                # A rewrite this large can't come back whole within MAX_OUTPUT_TOKENS, so only ask for the report
+                report_only = pyspark_tokens > MAX_PYSPARK_TOKENS
+
+                if queue_batch and etl_tokens + pyspark_tokens > MAX_PROMPT_TOKENS:
+                    st.error("❌ This file is too large to validate in one request, so it can't be queued for batch. Please run it interactively.")
+                    st.stop()
+
+                if etl_tokens + pyspark_tokens > MAX_PROMPT_TOKENS:
+                    # Map step: validate each part concurrently; the merged findings stand in for the ETL file below
+                    etl_chunks = split_etl(input_content, len(input_content) * ETL_CHUNK_TOKENS // etl_tokens)
+                    st.info(f"📦 Large ETL file: reviewing it in {len(etl_chunks)} parts first...")
+                    partial_reports = run_async(validate_etl_chunks(client, etl_chunks, etl_kind, pyspark_content))
+                    etl_context = (
+                        f"Findings from validating the ETL file (from {etl_kind}) in {len(etl_chunks)} parts:\n"
+                        + "\n\n".join(partial_reports)
+                    )
+                else:
+                    etl_context = f"Input ETL file (from {etl_kind}):\n{input_content}"
+
+                if report_only:
+                    rewrite_step = "2. Do not rewrite the PySpark code: it is too long to return in full."
+                    corrected_field = "an empty string"
+                else:
+                    rewrite_step = (
+                        "2. Rewrite the PySpark code so that it fully and correctly implements the ETL logic.\n"
+                        "   If the original file is already correct, return the same code unchanged."
+                    )
+                    corrected_field = "only the corrected PySpark code, without Markdown fences"
+
+                # One call returns both the report and the corrected code, so the large ETL/PySpark prefix is
+                # only sent (and prefilled) once. Static instructions come first so the prefix is cacheable server-side
+                prompt = f"""
+                You are an ETL to PySpark conversion validator and an expert PySpark converter.
+
+                1. Validate whether the PySpark code correctly implements the ETL logic.
+                   Provide a detailed validation report with clear sections:
+                   - ✅ Correct parts
+                   - ⚠️ Potential issues
+                   - ❌ Missing logic
+                   - 💡 Suggested improvements
+                {rewrite_step}
+
+                Respond with a JSON object with exactly two string fields, in this order:
+                - "report": the validation report (Markdown)
+                - "corrected": {corrected_field}
+                
+                {etl_context}
+
+                Output PySpark file:
+                {pyspark_content}
+                """
+
+                request = {
+                    "model": MODEL,
+                    "messages": [{"role": "user", "content": prompt}],
+                    "response_format": {"type": "json_object"},
+                    "temperature": 0,
+                    "max_tokens": VALIDATION_MAX_TOKENS + 512 if report_only else min(
+                        MAX_OUTPUT_TOKENS, VALIDATION_MAX_TOKENS + 2 * pyspark_tokens + 512
+                    ),
+                }
+
+                if queue_batch:
+                    batch = run_async(submit_batch(
+                        client, request, f"{etl_file.name} → {pyspark_file.name}", cache_key, batch_owner()
+                    ))
+                    add_batch_jobs(st.session_state.setdefault("batch_jobs", []), [batch_job(batch)])
+                    st.success(
+                        f"🕒 Queued as batch job `{batch.id}`. Results appear under Batch Jobs below once ready. "
+                        "Keep this page's URL, or the ID and the uploaded files, to look the job up later."
+                    )
+                else:
+                    validation_report, corrected_pyspark = stream_validation(client, request)
+                    st.success("✅ Validation Completed")
+                    if corrected_pyspark is not None:
+                        remember_response(cache_key, validation_report, corrected_pyspark)
 
         except Exception as e:
             st.error(f"Error during validation: {e}")
@@ -132,96 +595,289 @@ if st.button("🚀 Validate Conversion"):
         st.warning("⚠️ Please upload both an ETL file (Informatica/Datastage) and a PySpark file.")
 
 # ----------- Helper Functions for Reports -----------
+_SECTION_KEYS = (
+    ("correct parts", "Correct Parts"),
+    ("potential issues", "Potential Issues"),
+    ("missing logic", "Missing Logic"),
+    ("suggested improvements", "Suggested Improvements"),
+)
+
+_SECTION_BY_KEY = dict(_SECTION_KEYS)
+_NON_LETTERS_RE = re.compile(r"[^a-z ]")
+
+def section_heading(line):
+    # A heading is the section name alone, give or take "#", "*", emoji and numbering, e.g. "## ✅ Correct parts".
+    # Returns the section and whatever follows a ":" after the name ("**Potential issues**: join type differs")
+    head, _, rest = line.partition(":")
+    name = _SECTION_BY_KEY.get(_NON_LETTERS_RE.sub("", head.lower()).strip())
+    return name, rest.strip(" *_\t") if name else ""
+
 def parse_sections(text):
-    sections = {"Correct Parts": [], "Potential Issues": [], "Missing Logic": [], "Suggested Improvements": []}
+    sections = {name: [] for _, name in _SECTION_KEYS}
     current = None
     for line in text.split("\n"):
         line = line.strip()
-        if "Correct parts" in line or "Correct Parts" in line:
-            current = "Correct Parts"
-        elif "Potential issues" in line or "Potential Issues" in line:
-            current = "Potential Issues"
-        elif "Missing logic" in line or "Missing Logic" in line:
-            current = "Missing Logic"
-        elif "Suggested improvements" in line or "Suggested Improvements" in line:
-            current = "Suggested Improvements"
-        elif line.startswith("-") or line.startswith("•"):
-            if current:
-                sections[current].append(line.lstrip("-• ").strip())
+        is_bullet = line.startswith(("-", "•"))
+        if is_bullet:
+            # line is already stripped, so only the bullet markers need removing
+            line = line.lstrip("-• \t")
+        # Findings and prose often mention "missing logic" etc., so only a line that is the section name switches section
+        name, rest = section_heading(line)
+        if name:
+            current = name
+            if is_bullet and rest:
+                sections[current].append(rest)
+        elif is_bullet and current and line:
+            sections[current].append(line)
     return sections
 
-def create_pdf(sections):
+# reportlab is imported lazily: Streamlit reruns this script on every widget change,
+# and the import is only needed once a report is exported
+# Paragraph parses its text as mini-markup, so "<", ">" and "&" from SQL/code snippets must be escaped
+_PARAGRAPH_ESCAPE = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;"})
+
+def create_pdf_platypus(sections):
+    from reportlab.lib.pagesizes import letter
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, ListFlowable, ListItem
+
     buffer = BytesIO()
     doc = SimpleDocTemplate(buffer, pagesize=letter)
-    styles = getSampleStyleSheet()
+    styles = get_styles()
+    title, heading, normal = styles["Title"], styles["Heading2"], styles["Normal"]
+    # Spacer is never mutated during layout, so one instance can be placed repeatedly
+    spacer = Spacer(1, 12)
     elements = []
 
-    elements.append(Paragraph("ETL → PySpark Validation Report", styles["Title"]))
-    elements.append(Spacer(1, 12))
+    elements.append(Paragraph("ETL → PySpark Validation Report", title))
+    elements.append(spacer)
 
     for sec, items in sections.items():
-        elements.append(Paragraph(sec, styles["Heading2"]))
+        elements.append(Paragraph(sec, heading))
         if items:
             bullet_list = ListFlowable(
-                [ListItem(Paragraph(item, styles["Normal"])) for item in items],
+                [ListItem(Paragraph(item.translate(_PARAGRAPH_ESCAPE), normal)) for item in items],
                 bulletType="bullet",
             )
             elements.append(bullet_list)
         else:
-            elements.append(Paragraph("No findings.", styles["Normal"]))
-        elements.append(Spacer(1, 12))
+            elements.append(Paragraph("No findings.", normal))
+        elements.append(spacer)
 
     doc.build(elements)
     buffer.seek(0)
     return buffer
 
-def create_docx(sections):
+def create_pdf(sections):
+    from reportlab.lib.pagesizes import letter
+    from reportlab.lib.utils import simpleSplit
+    from reportlab.pdfgen import canvas
+
+    # Precompute the fixed report layout as (font, size, x, y, text) rows. If it fits on one page,
+    # draw it straight onto a canvas and skip Platypus' wrap/split layout loop
+    width, height = letter
+    y = height - 72 - 18
+    rows = [("Helvetica-Bold", 18, 72, y, "ETL → PySpark Validation Report")]
+    y -= 30
+    for sec, items in sections.items():
+        rows.append(("Helvetica-Bold", 14, 72, y, sec))
+        y -= 20
+        if items:
+            for item in items:
+                rows.append(("Helvetica", 11, 80, y, "•"))
+                for line in simpleSplit(item, "Helvetica", 11, width - 92 - 72) or [""]:
+                    rows.append(("Helvetica", 11, 92, y, line))
+                    y -= 14
+        else:
+            rows.append(("Helvetica", 11, 72, y, "No findings."))
+            y -= 14
+        y -= 12
+
+    if rows[-1][3] < 72:
+        return create_pdf_platypus(sections)
+
     buffer = BytesIO()
-    doc = Document()
-    doc.add_heading("ETL → PySpark Validation Report", 0)
+    c = canvas.Canvas(buffer, pagesize=letter)
+    current_font = None
+    for font, size, x, y, text in rows:
+        if (font, size) != current_font:
+            c.setFont(font, size)
+            current_font = (font, size)
+        c.drawString(x, y, text)
+    c.save()
+    buffer.seek(0)
+    return buffer
+
+# ----------- Minimal DOCX package (written directly; no python-docx object model) -----------
+_W_NS = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+_DOCX_PARTS = {
+    "[Content_Types].xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+        '<Override PartName="/word/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.styles+xml"/>'
+        '<Override PartName="/word/numbering.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.numbering+xml"/>'
+        '</Types>'
+    ),
+    "_rels/.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="word/document.xml"/>'
+        '</Relationships>'
+    ),
+    "word/_rels/document.xml.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>'
+        '<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/numbering" Target="numbering.xml"/>'
+        '</Relationships>'
+    ),
+    "word/styles.xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        f'<w:styles xmlns:w="{_W_NS}">'
+        '<w:docDefaults><w:rPrDefault><w:rPr><w:rFonts w:ascii="Calibri" w:hAnsi="Calibri" w:cs="Calibri"/>'
+        '<w:sz w:val="22"/></w:rPr></w:rPrDefault>'
+        '<w:pPrDefault><w:pPr><w:spacing w:after="120"/></w:pPr></w:pPrDefault></w:docDefaults>'
+        '<w:style w:type="paragraph" w:default="1" w:styleId="Normal"><w:name w:val="Normal"/></w:style>'
+        '<w:style w:type="paragraph" w:styleId="Title"><w:name w:val="Title"/><w:basedOn w:val="Normal"/>'
+        '<w:pPr><w:spacing w:after="240"/></w:pPr><w:rPr><w:sz w:val="52"/></w:rPr></w:style>'
+        '<w:style w:type="paragraph" w:styleId="Heading1"><w:name w:val="heading 1"/><w:basedOn w:val="Normal"/>'
+        '<w:pPr><w:keepNext/><w:spacing w:before="240"/><w:outlineLvl w:val="0"/></w:pPr>'
+        '<w:rPr><w:b/><w:color w:val="365F91"/><w:sz w:val="28"/></w:rPr></w:style>'
+        '<w:style w:type="paragraph" w:styleId="ListBullet"><w:name w:val="List Bullet"/><w:basedOn w:val="Normal"/>'
+        '<w:pPr><w:numPr><w:numId w:val="1"/></w:numPr><w:spacing w:after="60"/></w:pPr></w:style>'
+        '</w:styles>'
+    ),
+    "word/numbering.xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        f'<w:numbering xmlns:w="{_W_NS}">'
+        '<w:abstractNum w:abstractNumId="0"><w:lvl w:ilvl="0"><w:start w:val="1"/><w:numFmt w:val="bullet"/>'
+        '<w:lvlText w:val="•"/><w:lvlJc w:val="left"/><w:pPr><w:ind w:left="720" w:hanging="360"/></w:pPr></w:lvl>'
+        '</w:abstractNum>'
+        '<w:num w:numId="1"><w:abstractNumId w:val="0"/></w:num>'
+        '</w:numbering>'
+    ),
+}
+_DOCX_DOCUMENT = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    f'<w:document xmlns:w="{_W_NS}"><w:body>{{body}}'
+    '<w:sectPr><w:pgSz w:w="12240" w:h="15840"/>'
+    '<w:pgMar w:top="1440" w:right="1440" w:bottom="1440" w:left="1440" w:header="720" w:footer="720" w:gutter="0"/>'
+    '</w:sectPr></w:body></w:document>'
+)
+
+# Control characters that are illegal in XML 1.0; escape() leaves them in place and Word rejects the file
+_XML_ILLEGAL_RE = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+def docx_paragraph(text, style):
+    return (
+        f'<w:p><w:pPr><w:pStyle w:val="{style}"/></w:pPr>'
+        f'<w:r><w:t xml:space="preserve">{escape(_XML_ILLEGAL_RE.sub("", text))}</w:t></w:r></w:p>'
+    )
 
+def create_docx(sections):
+    body = [docx_paragraph("ETL → PySpark Validation Report", "Title")]
     for sec, items in sections.items():
-        doc.add_heading(sec, level=1)
+        body.append(docx_paragraph(sec, "Heading1"))
         if items:
-            for item in items:
-                doc.add_paragraph(item, style="List Bullet")
+            body.extend(docx_paragraph(item, "ListBullet") for item in items)
         else:
-            doc.add_paragraph("No findings.")
-    doc.save(buffer)
+            body.append(docx_paragraph("No findings.", "Normal"))
+
+    buffer = BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as docx:
+        for name, xml in _DOCX_PARTS.items():
+            docx.writestr(name, xml)
+        docx.writestr("word/document.xml", _DOCX_DOCUMENT.format(body="".join(body)))
     buffer.seek(0)
     return buffer
 
+# Keyed on the raw report text, so a cache hit skips parsing as well as both builds.
+# (functools.lru_cache would not survive reruns: the script body, and so the function, is re-executed each time)
+@st.cache_data(show_spinner=False, max_entries=8)
+def build_reports(report):
+    sections = parse_sections(report)
+    # Both builders spend much of their time in C code (zlib, zip writing), so run them side by side
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        pdf_future = executor.submit(create_pdf, sections)
+        docx_future = executor.submit(create_docx, sections)
+        return pdf_future.result().getvalue(), docx_future.result().getvalue()
+
 # ----------- Download Section -----------
-if validation_report:
+def show_downloads(report, corrected, key):
     col1, col2 = st.columns(2)
-    sections = parse_sections(validation_report)
-
-    pdf_file = create_pdf(sections)
-    docx_file = create_docx(sections)
+    pdf_file, docx_file = build_reports(report)
 
     with col1:
         st.download_button(
             label="⬇️ Download Report (PDF)",
             data=pdf_file,
             file_name="Validation_Report.pdf",
-            mime="application/pdf"
+            mime="application/pdf",
+            key=f"{key}-pdf"
         )
     with col2:
         st.download_button(
             label="⬇️ Download Report (Word)",
             data=docx_file,
             file_name="Validation_Report.docx",
-            mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+            mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+            key=f"{key}-docx"
         )
 
-# ----------- Corrected PySpark Download -----------
-if corrected_pyspark:
-    st.markdown("### 🛠️ Corrected PySpark Code")
-    st.code(corrected_pyspark, language="python")
+    # ----------- Corrected PySpark Download -----------
+    if corrected:
+        st.download_button(
+            label="⬇️ Download Corrected PySpark File",
+            data=corrected.encode("utf-8"),
+            file_name="Corrected_PySpark.py",
+            mime="text/x-python",
+            key=f"{key}-py"
+        )
 
-    st.download_button(
-        label="⬇️ Download Corrected PySpark File",
-        data=corrected_pyspark.encode("utf-8"),
-        file_name="Corrected_PySpark.py",
-        mime="text/x-python"
-    )
+if validation_report:
+    show_downloads(validation_report, corrected_pyspark, "current")
+
+# ----------- Batch Jobs -----------
+st.markdown("### 🕒 Batch Jobs")
+lookup_batch_id = st.text_input("Batch job ID (optional)", placeholder="batch_...").strip()
+# Polled on demand: Streamlit session state can't be updated from a background thread.
+# Refreshing also reloads this browser's recent jobs from OpenAI, so a reload or expired session loses nothing.
+if st.button("🔄 Refresh Batch Status"):
+    batch_jobs = st.session_state.setdefault("batch_jobs", [])
+    try:
+        client = get_client()
+        try:
+            upload_key = None
+            if lookup_batch_id and (informatica_file or datastage_file) and pyspark_file:
+                upload_key = (
+                    read_upload(informatica_file or datastage_file)[1],
+                    read_upload(pyspark_file)[1],
+                    "Informatica" if informatica_file else "Datastage",
+                    MODEL,
+                )
+            add_batch_jobs(
+                batch_jobs, run_async(load_batch_jobs(client, batch_owner(), lookup_batch_id, upload_key))
+            )
+        except Exception as e:
+            st.error(f"Error while looking up batch jobs: {e}")
+        run_async(refresh_batch_jobs(client, batch_jobs))
+    except Exception as e:
+        st.error(f"Error while checking batch jobs: {e}")
+
+for job in st.session_state.get("batch_jobs", []):
+    with st.expander(f"{job['name']} · `{job['id']}` · {job['status']}"):
+        if "error" in job:
+            st.error(job["error"])
+        elif "report" in job:
+            st.write(job["report"])
+            if job["corrected"]:
+                st.code(job["corrected"], language="python")
+            else:
+                st.warning(INCOMPLETE_CORRECTION_WARNING)
+            show_downloads(job["report"], job["corrected"], job["id"])
+        else:
+            if "refresh_error" in job:
+                st.warning(job["refresh_error"])
+            st.info("⏳ Still processing. Use Refresh Batch Status to check again.")